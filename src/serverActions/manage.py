@@ -4,23 +4,59 @@ Jupyter Lab Provisioning Script for Fly.io
 
 This script creates and manages Jupyter Lab instances on Fly.io for students.
 It uses the Fly Machines API directly to create and manage the instances.
-Zero external dependencies - uses only the standard library.
+Zero external dependencies - uses only the standard library, with orjson
+and pysimdjson picked up as faster JSON backends when they are installed.
 """
 
 from __future__ import annotations
 
 import os
 import sys
-import json
 import argparse
-import urllib.request
-import urllib.error
-import urllib.parse
+import csv
+import http.client
+import threading
 from dataclasses import asdict
-from typing import Dict
+from typing import Callable, Dict
 from pathlib import Path
 from enum import Enum
 import platform
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+
+    def _dumps_pretty(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+
+except ImportError:
+    import json
+
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+    def _dumps_pretty(obj) -> bytes:
+        return json.dumps(obj, indent=2).encode("utf-8")
+
+    _loads = json.loads
+
+try:
+    import simdjson
+
+    # A single parser is reused for lazy parsing; each parse invalidates the
+    # documents returned by the previous one.
+    _lazy_parser = simdjson.Parser()
+
+    def _loads_lazy(raw: bytes):
+        return _lazy_parser.parse(raw)
+
+except ImportError:
+    _loads_lazy = _loads
 
 try:
     sys.path.append(Path(__file__).parent.parent.as_posix())
@@ -35,13 +71,19 @@ except Exception as e:
     print("[Χ] Could not load modules into path")
     sys.exit(1)
 
-essential_keys = [
-    "FLY_ORGANIZATION",
-    "BASE_DOMAIN",
-    "JUPYTER_IMAGE",
-    "FLY_API_TOKEN",
-    "APP_NAME",
-]
+BATCH_MAX_WORKERS = 20
+APP_SENTINEL_TTL = 3600
+APP_SENTINEL_FILE = Path.home() / ".fly-configs/_app_ok"
+
+ESSENTIAL_KEYS = frozenset(
+    (
+        "FLY_ORGANIZATION",
+        "BASE_DOMAIN",
+        "JUPYTER_IMAGE",
+        "FLY_API_TOKEN",
+        "APP_NAME",
+    )
+)
 
 
 class Color(str, Enum):
@@ -52,13 +94,6 @@ class Color(str, Enum):
     UNDERLINE = "\033[4m"
 
 
-class Command(str, Enum):
-    LIST = "list"
-    SPIN = "spin"
-    SHUTDOWN = "shutdown"
-    DELETE = "delete"
-
-
 class HTTPMethod(str, Enum):
     GET = "GET"
     POST = "POST"
@@ -75,8 +110,65 @@ class CliCommand(str, Enum):
     BATCH = "batch"
 
 
+# Escape codes are resolved once, and dropped when the output is not a terminal
+_COLOR_WRAP = {
+    color: (color.value, Color.ENDC.value) if sys.stdout.isatty() else ("", "")
+    for color in Color
+}
+
+
 def pretty_print(contents: str, color: Color = Color.OKGREEN) -> None:
-    print(f"{color.value}{contents}{Color.ENDC.value}")
+    prefix, suffix = _COLOR_WRAP[color]
+    # A single write keeps lines from concurrent batch workers from interleaving
+    sys.stdout.write(f"{prefix}{contents}{suffix}\n")
+
+
+IDEMPOTENT_METHODS = frozenset(
+    (HTTPMethod.GET.value, HTTPMethod.PUT.value, HTTPMethod.DELETE.value)
+)
+
+_connections = threading.local()
+
+
+def _get_connection() -> http.client.HTTPSConnection:
+    """Get the keep-alive connection to the API for the current thread"""
+    connection = getattr(_connections, "connection", None)
+    if connection is None:
+        connection = http.client.HTTPSConnection(FLY_API_HOST, timeout=30)
+        _connections.connection = connection
+        _connections.reused = False
+    return connection
+
+
+def _drop_connection() -> None:
+    connection = getattr(_connections, "connection", None)
+    if connection is not None:
+        connection.close()
+        _connections.connection = None
+
+
+def _send_request(
+    method: str, path: str, body: bytes | None, headers: Dict[str, str]
+) -> http.client.HTTPResponse:
+    connection = _get_connection()
+    reused = _connections.reused
+    sent = False
+    try:
+        connection.request(method, path, body=body, headers=headers)
+        sent = True
+        response = connection.getresponse()
+    except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+        _drop_connection()
+        # The API closes idle keep-alive connections, so a failure on a reused
+        # one is retried once on a fresh connection. Requests the API may have
+        # already acted on are only replayed when repeating them is harmless.
+        if not reused or (sent and method not in IDEMPOTENT_METHODS):
+            raise
+        connection = _get_connection()
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+    _connections.reused = True
+    return response
 
 
 def make_api_request(
@@ -84,58 +176,56 @@ def make_api_request(
     path: str,
     data: Dict[str, str] | None = None,
     headers: Dict[str, str] | None = None,
+    lazy: bool = False,
 ) -> Dict[str, str]:
-    """Makes an API request to Fly.io Machines API"""
-    if not headers:
-        headers = dict()
-        headers["Authorization"] = f"Bearer {FLY_API_TOKEN}"
-        headers["Content-Type"] = "application/json"
-
-    url = f"https://{FLY_API_HOST}{path}"
-
-    request = urllib.request.Request(
-        url=url,
-        data=json.dumps(data).encode("utf-8") if data else None,
-        headers=headers,
-        method=method,
-    )
+    """Makes an API request to Fly.io Machines API
 
+    With `lazy` set the response is parsed into a read-only proxy that only
+    decodes the fields that are accessed; it is only valid until the next
+    lazy request.
+    """
     try:
-        with urllib.request.urlopen(request) as response:
-            if response.getcode() not in [200, 201, 204]:
-                return {
-                    "status": response.getcode(),
-                    "error": response.read().decode("utf-8"),
-                }
+        response = _send_request(
+            HTTPMethod(method).value,
+            path,
+            _dumps(data) if data else None,
+            headers or DEFAULT_HEADERS,
+        )
+        status = response.status
+        body = response.read()
+    except Exception as e:
+        _drop_connection()
+        return {"status": 500, "error": str(e)}
+
+    if status in [200, 201, 204]:
+        try:
             return {
-                "status": response.getcode(),
+                "status": status,
                 "data": (
-                    json.loads(response.read().decode("utf-8"))
-                    if response.getcode() != 204
-                    else None
+                    (_loads_lazy if lazy else _loads)(body) if status != 204 else None
                 ),
             }
-
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode("utf-8")
-        try:
-            error_json = json.loads(error_body)
-            return {"status": e.code, "error": error_json}
-        except:
-            return {"status": e.code, "error": error_body}
-    except Exception as e:
-        return {"status": 500, "error": str(e)}
+        except Exception as e:
+            return {"status": 500, "error": str(e)}
+    if status < 400:
+        return {"status": status, "error": body.decode("utf-8", errors="replace")}
+    try:
+        return {"status": status, "error": _loads(body)}
+    except:
+        return {"status": status, "error": body.decode("utf-8", errors="replace")}
 
 
 def create_volume(student_id: str) -> str | None:
     data = {"region": "ams", "name": f"vol_{student_id}", "size_gb": 1}
     result = make_api_request(
         "POST",
-        f"/v1/apps/{APP_NAME}/volumes",
+        VOLUMES_PATH,
         data=data,
-        headers=common_headers,
     )
 
+    if result["status"] == 404:
+        # The app may have been removed since it was last seen
+        _forget_app()
     if result["status"] not in [200, 201]:
         pretty_print(
             f"Failed to create volume: \n[Status:{result['status']}] {result.get('error', 'Unknown error')}",
@@ -152,29 +242,27 @@ def create_volume(student_id: str) -> str | None:
 
 def create_machine(student_id: str, volume_id: str) -> Dict[str, str] | None:
     """Create a new machine for the app"""
-    machine_config = MachineConfig(
-        image=JUPYTER_IMAGE,
-        env={"STUDENT_ID": student_id},
-        mounts=[MachineMount(volume=volume_id)],
-        services=[
-            MachineService(
-                internal_port=INTERNAL_PORT,
-                http_options={
-                    "idle_timeout": IDLE_TIMEOUT,
-                    "h2_backend": True,
-                },
-            )
-        ],
-    )
-    data = MachineCreate(name=f"{FLY_APP_PREFIX}{student_id}", config=machine_config)
+    # Only the student specific fields differ between machines, so they are
+    # laid over the shared template instead of serializing a new MachineCreate
+    data = {
+        **MACHINE_CREATE_TEMPLATE,
+        "name": f"{FLY_APP_PREFIX}{student_id}",
+        "config": {
+            **MACHINE_CREATE_TEMPLATE["config"],
+            "env": {"STUDENT_ID": student_id},
+            "mounts": [asdict(MachineMount(volume=volume_id))],
+        },
+    }
 
     result = make_api_request(
         "POST",
-        f"/v1/apps/{APP_NAME}/machines",
-        data=asdict(data),
-        headers=common_headers,
+        MACHINES_PATH,
+        data=data,
     )
 
+    if result["status"] == 404:
+        # The app may have been removed since it was last seen
+        _forget_app()
     if result["status"] not in [200, 201]:
         pretty_print(
             f"Failed to create machine: \n[Status:{result['status']}] {result.get('error', 'Unknown error')}",
@@ -185,11 +273,61 @@ def create_machine(student_id: str, volume_id: str) -> Dict[str, str] | None:
     return {"instance_id": result["data"]["instance_id"]}
 
 
+def _sentinel_fresh(app_name: str) -> bool:
+    """Whether a recent run has already seen the app"""
+    try:
+        name, _, expires_at = APP_SENTINEL_FILE.read_text().partition("\n")
+        return name == app_name and float(expires_at) > time.time()
+    except (OSError, ValueError):
+        return False
+
+
+def _touch_sentinel(app_name: str) -> None:
+    try:
+        APP_SENTINEL_FILE.parent.mkdir(parents=True, exist_ok=True)
+        APP_SENTINEL_FILE.write_text(f"{app_name}\n{time.time() + APP_SENTINEL_TTL}")
+    except OSError:
+        # The sentinel only saves a request, failing to write it is harmless
+        pass
+
+
+def _forget_app() -> None:
+    try:
+        APP_SENTINEL_FILE.unlink(missing_ok=True)
+    except OSError:
+        pass
+    with _known_apps_lock:
+        _known_apps.clear()
+
+
+_known_apps: set[str] = set()
+_known_apps_lock = threading.Lock()
+
+
+def _app_exists(app_name: str) -> bool:
+    """Check once per run whether the app exists
+
+    Only apps that were found are remembered, so a failed check is retried
+    by the next caller. The lock makes concurrent callers wait for a single
+    request instead of each sending their own. A successful check is also
+    recorded on disk, so runs within APP_SENTINEL_TTL seconds of it skip the
+    request altogether.
+    """
+    with _known_apps_lock:
+        if app_name in _known_apps:
+            return True
+        if not _sentinel_fresh(app_name):
+            result = make_api_request("GET", f"/v1/apps/{app_name}")
+            if result["status"] != 200:
+                return False
+            _touch_sentinel(app_name)
+        _known_apps.add(app_name)
+        return True
+
+
 def provision_jupyter(student_id: str):
     """Provision a new Jupyter Lab instance for a student"""
-    app_exists = make_api_request("GET", f"/v1/apps/{APP_NAME}", headers=common_headers)
-
-    if app_exists["status"] != 200:
+    if not _app_exists(APP_NAME):
         pretty_print(
             f"Failed to get information about machines; app = {APP_NAME}",
             Color.ERRORRED,
@@ -218,13 +356,23 @@ def provision_jupyter(student_id: str):
         "url": f"https://{APP_NAME}.{BASE_DOMAIN}/lab?token={student_id}",
     }
 
-    with open(config_dir / "access.json", "+a") as f:
-        json.dump(access_info, f, indent=2)
+    # Write to a temporary file and swap it in, so that re-provisioning
+    # replaces the previous file instead of appending a second JSON document
+    tmp_file = tempfile.NamedTemporaryFile(
+        dir=config_dir, prefix="access.", suffix=".tmp", delete=False
+    )
+    try:
+        with tmp_file:
+            tmp_file.write(_dumps_pretty(access_info))
+        os.replace(tmp_file.name, config_dir / "access.json")
+    except Exception:
+        Path(tmp_file.name).unlink(missing_ok=True)
+        raise
 
 
-def get_machines():
+def get_machines(lazy: bool = False):
     """Get all machines for an app"""
-    result = make_api_request("GET", f"/v1/apps/{APP_NAME}/machines")
+    result = make_api_request("GET", MACHINES_PATH, lazy=lazy)
 
     if result["status"] != 200:
         return list()
@@ -232,6 +380,93 @@ def get_machines():
     return result["data"]
 
 
+def list_instances() -> list[Dict[str, str]]:
+    """List the student machines of the app with their current state"""
+    instances = list()
+    for machine in get_machines(lazy=True):
+        name = machine["name"]
+        if not name.startswith(FLY_APP_PREFIX):
+            continue
+        instances.append(
+            {
+                "id": machine["id"],
+                "student_id": name[len(FLY_APP_PREFIX) :],
+                "state": machine["state"],
+            }
+        )
+    return instances
+
+
+def provision_batch(file: str) -> None:
+    """Provision instances for every student listed in a CSV file.
+
+    Requests are network bound, so they are issued from a bounded pool of
+    worker threads instead of one after the other. Rows are read as workers
+    free up, so the file is never loaded in full.
+    """
+    if not _app_exists(APP_NAME):
+        pretty_print(
+            f"Failed to get information about machines; app = {APP_NAME}",
+            Color.ERRORRED,
+        )
+        return
+
+    slots = threading.BoundedSemaphore(BATCH_MAX_WORKERS)
+
+    def provision(student_id: str) -> None:
+        try:
+            provision_jupyter(student_id)
+        except Exception as e:
+            pretty_print(
+                f"[X] Failed to provision {student_id}: {e}", Color.ERRORRED
+            )
+        finally:
+            slots.release()
+
+    with (
+        open(file, "r", newline="") as f,
+        ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS) as executor,
+    ):
+        reader = csv.reader(f)
+        student_ids = (row[0].strip() for row in reader if row)
+        for student_id in student_ids:
+            if not student_id or student_id.startswith("#"):
+                continue
+            # The file may start with a student_id,enrolled_date,... header
+            if reader.line_num == 1 and student_id == "student_id":
+                continue
+            slots.acquire()
+            executor.submit(provision, student_id)
+
+
+def provision_cmd(args: argparse.Namespace) -> None:
+    provision_jupyter(args.student_id)
+
+
+def list_cmd(args: argparse.Namespace) -> None:
+    import pprint
+
+    pprint.pprint(list_instances())
+
+
+def batch_cmd(args: argparse.Namespace) -> None:
+    provision_batch(args.file)
+
+
+def not_implemented_cmd(args: argparse.Namespace) -> None:
+    raise NotImplementedError
+
+
+DISPATCH: Dict[str, Callable[[argparse.Namespace], None]] = {
+    CliCommand.PROVISION.value: provision_cmd,
+    CliCommand.STOP.value: not_implemented_cmd,
+    CliCommand.START.value: not_implemented_cmd,
+    CliCommand.DELETE.value: not_implemented_cmd,
+    CliCommand.LIST.value: list_cmd,
+    CliCommand.BATCH.value: batch_cmd,
+}
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Manage Jupyter Lab instances on Fly.io"
@@ -276,24 +511,11 @@ def main():
 
     args = parser.parse_args()
 
-    match args.command:
-        case CliCommand.PROVISION.value:
-            provision_jupyter(args.student_id)
-        case CliCommand.STOP.value:
-            raise NotImplementedError
-        case CliCommand.START.value:
-            raise NotImplementedError
-        case CliCommand.DELETE.value:
-            raise NotImplementedError
-        case CliCommand.LIST.value:
-            import pprint
-
-            pprint.pprint(get_machines())
-        case CliCommand.BATCH.value:
-            raise NotImplementedError
-
-        case _:
-            parser.print_help()
+    handler = DISPATCH.get(args.command)
+    if handler is None:
+        parser.print_help()
+        return
+    handler(args)
 
 
 def run_system_checks() -> bool:
@@ -305,16 +527,16 @@ def run_system_checks() -> bool:
     if not env_file.exists():
         pretty_print("[X] .env file not found", Color.ERRORRED)
         return False
-    with open(env_file.as_posix(), "r") as f:
-        for line in f.readlines():
-            line = line.strip()
-            if line.startswith("#") or not line:
-                continue
-            key, value = line.split("=", 1)
-            if key not in essential_keys:
-                continue
-            os.environ[key] = value
-    if not all(os.environ.get(key) for key in essential_keys):
+    for line in env_file.read_bytes().splitlines():
+        line = line.strip()
+        if not line or line[:1] == b"#":
+            continue
+        key, _, value = line.partition(b"=")
+        key = key.decode("utf-8")
+        if key not in ESSENTIAL_KEYS:
+            continue
+        os.environ[key] = value.decode("utf-8")
+    if not all(os.environ.get(key) for key in ESSENTIAL_KEYS):
         pretty_print("[X] Missing required environment variables", Color.ERRORRED)
         return False
     return True
@@ -331,6 +553,9 @@ if __name__ == "__main__":
     FLY_API_HOST = os.environ.get("FLY_API_HOST", "api.machines.dev")
     FLY_APP_PREFIX = os.environ.get("FLY_APP_PREFIX", "jupyter-")
     APP_NAME = os.environ.get("APP_NAME", "")
+    APP_PATH = f"/v1/apps/{APP_NAME}"
+    MACHINES_PATH = f"{APP_PATH}/machines"
+    VOLUMES_PATH = f"{APP_PATH}/volumes"
     try:
         INTERNAL_PORT = int(os.environ.get("INTERNAL_PORT", "8888"))
         IDLE_TIMEOUT = int(os.environ.get("IDLE_TIMEOUT", "300"))
@@ -340,7 +565,27 @@ if __name__ == "__main__":
         )
         sys.exit(1)
 
-    common_headers = {
+    MACHINE_CREATE_TEMPLATE = asdict(
+        MachineCreate(
+            name="",
+            config=MachineConfig(
+                image=JUPYTER_IMAGE,
+                env={},
+                mounts=[],
+                services=[
+                    MachineService(
+                        internal_port=INTERNAL_PORT,
+                        http_options={
+                            "idle_timeout": IDLE_TIMEOUT,
+                            "h2_backend": True,
+                        },
+                    )
+                ],
+            ),
+        )
+    )
+
+    DEFAULT_HEADERS = {
         "User-Agent": "Fidiaitera-Provision/0.1",
         "Authorization": f"Bearer {FLY_API_TOKEN}",
         "Content-Type": "application/json",
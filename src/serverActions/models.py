@@ -1,14 +1,14 @@
 from dataclasses import dataclass, field
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class MachineMount:
     volume: str
     encrypted: bool = True
     path: str = "/home/jovyan/student_data"
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class MachineService:
     http_options: dict
     autostart: bool = True
@@ -32,7 +32,7 @@ class MachineService:
     protocol: str = "tcp"
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class MachineConfig:
     image: str
     env: dict[str, str]
@@ -52,7 +52,7 @@ class MachineConfig:
     )
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class MachineCreate:
     name: str
     config: MachineConfig